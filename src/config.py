@@ -57,14 +57,28 @@ def get_and_validate_env(var_name, display_name):
 api_key = get_and_validate_env("OPENAI_API_KEY", "OpenAI API key")
 mongo_uri = get_and_validate_env("MONGO_CONNECTION_STRING", "MongoDB connection string")
 
+@st.cache_resource
+def get_client():
+    """Create the OpenAI client once per process and reuse it across reruns."""
+    # The SDK retries 429s, 5xx and connection errors with exponential backoff and jitter;
+    # allow a few more attempts than the default 2 since uploads now run concurrently
+    return OpenAI(api_key=api_key, max_retries=5)
+
+@st.cache_resource
+def get_db():
+    """Open the MongoDB connection once per process and reuse it across reruns."""
+    # Keep a warm pool of connections so concurrent Streamlit sessions
+    # don't pay connection setup on every request
+    return connect(host=mongo_uri, maxPoolSize=100, minPoolSize=20, waitQueueTimeoutMS=2500)
+
 # Initialize OpenAI client and MongoDB connection if keys are present
 if api_key:
-    client = OpenAI(api_key=api_key)
+    get_client()
     logging.debug("OpenAI API key loaded successfully.")
 
 if mongo_uri:
     try:
-        connect(host=mongo_uri)
+        get_db()
         logging.debug("Connected to MongoDB.")
     except Exception as e:
         logging.error(f"Failed to connect to MongoDB: {str(e)}")
@@ -1,32 +1,66 @@
-from datetime import datetime
+"""
+MongoEngine document models for Study Buddy.
 
-from mongoengine import Document, ListField, StringField, EmailField, ReferenceField, DateTimeField, CASCADE
+All models share the single default connection opened in config.py. That
+connection is pooled (maxPoolSize=100, minPoolSize=20, waitQueueTimeoutMS=2500)
+so concurrent Streamlit sessions reuse warm sockets instead of opening new ones.
+"""
+from datetime import datetime, timezone
+
+from mongoengine import Document, ListField, StringField, EmailField, ReferenceField, DateTimeField, CASCADE, signals
+
+def set_timestamps(sender, document, **kwargs):
+    """Stamp unset created_at/updated_at fields once, right before the document is saved."""
+    now = datetime.now(timezone.utc)
+    for field_name in ('created_at', 'updated_at'):
+        if field_name in document._fields and document[field_name] is None:
+            document[field_name] = now
+
+# Timestamps are filled in at save time rather than by field defaults, which
+# would call datetime.now() for every instantiated (including loaded) document
+signals.pre_save.connect(set_timestamps)
 
 class User(Document):
     username = StringField(required=True, unique=True)
     name = StringField(required=True)
     email = EmailField(required=True, unique=True)
-    created_at = DateTimeField(default=datetime.now)
+    created_at = DateTimeField()
 
 class File(Document):
     file_id = StringField(required=True, unique=True)
     name = StringField(required=True)
+    content_hash = StringField()  # BLAKE2b digest of the file bytes, used to skip re-uploads
     user = ReferenceField(User, required=True, reverse_delete_rule=CASCADE)
-    created_at = DateTimeField(default=datetime.now)
+    created_at = DateTimeField()
+
+    meta = {
+        'indexes': [('user', 'content_hash')]
+    }
 
 class VectorStore(Document):
     vector_store_id = StringField(required=True, unique=True)
     name = StringField(required=True)
     user = ReferenceField(User, required=True, reverse_delete_rule=CASCADE)
-    created_at = DateTimeField(default=datetime.now)
-    updated_at = DateTimeField(default=datetime.now)
+    created_at = DateTimeField()
+    updated_at = DateTimeField()
+
+    meta = {
+        # Serves get_user_vector_stores' per-user listing from the index
+        'indexes': [('user', 'name')]
+    }
 
 class Assistant(Document):
     assistant_id = StringField(required=True, unique=True)
     name = StringField(required=True)
     vector_store = ReferenceField(VectorStore, required=True)
+    vector_store_id = StringField()  # Denormalized OpenAI ID, avoids dereferencing vector_store
     user = ReferenceField(User, required=True, reverse_delete_rule=CASCADE)
-    created_at = DateTimeField(default=datetime.now)
+    created_at = DateTimeField()
+
+    meta = {
+        # Serves get_user_assistants' per-user listing from the index
+        'indexes': [('user', 'vector_store')]
+    }
 
 class Thread(Document):
     thread_id = StringField(required=True, unique=True)
@@ -34,11 +68,21 @@ class Thread(Document):
     assistant_id = StringField(required=True)
     title = StringField(required=True)
     user = ReferenceField(User, required=True, reverse_delete_rule=CASCADE)
-    created_at = DateTimeField(default=datetime.now)
-    updated_at = DateTimeField(default=datetime.now)
+    created_at = DateTimeField()
+    updated_at = DateTimeField()
+
+    meta = {
+        # Serves get_threads' per-user, most-recent-first listing from the index
+        'indexes': [('user', '-updated_at')]
+    }
 
 class Message(Document):
     thread = ReferenceField(Thread, required=True, reverse_delete_rule=CASCADE)
     role = StringField(required=True)
     content = StringField(required=True)
-    created_at = DateTimeField()
\ No newline at end of file
+    created_at = DateTimeField()
+
+    meta = {
+        # Serves get_messages' per-thread, time-ordered keyset pages from the index
+        'indexes': [('thread', 'created_at', 'id')]
+    }
\ No newline at end of file
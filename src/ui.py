@@ -1,24 +1,38 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import streamlit as st
 
-from config import client
-from models import Thread, File, VectorStore, Assistant
+from config import get_client
 from utils import (
+    add_footnotes,
+    compute_content_hash,
     create_vector_store,
     create_assistant,
     create_thread,
     delete_thread,
+    get_existing_content_hashes,
     get_messages,
     get_threads,
     get_user_files,
     get_user_vector_stores,
     get_user_assistants,
-    handle_file_upload,
-    save_message
+    io_executor,
+    save_message,
+    save_uploaded_file
 )
-from openai.types.beta.assistant_stream_event import ThreadMessageDelta
-from openai.types.beta.threads.text_delta_block import TextDeltaBlock
+
+# Number of study sessions loaded into the sidebar per page
+THREAD_PAGE_SIZE = 50
+
+# Number of chat messages rendered per page of history
+MESSAGE_PAGE_SIZE = 20
+
+# Minimum number of new characters before the streaming response is redrawn
+STREAM_FLUSH_CHARS = 24
+
+# Cap on simultaneous OpenAI file uploads, to stay clear of rate limits
+MAX_CONCURRENT_UPLOADS = 8
 
 def display_home(current_user):
     """Display the home page."""
@@ -33,29 +47,58 @@ def display_home(current_user):
     Use the sidebar to navigate between different sections and select your study sessions!
     """)
 
+@st.cache_data(ttl=60, max_entries=128)
+def _cached_user_files(user_id):
+    """Return (id, name, file_id) tuples for the user's files, cached across reruns."""
+    # scalar() projects server-side and skips building Documents
+    return [(str(pk), name, file_id) for pk, name, file_id in get_user_files(user_id).scalar('id', 'name', 'file_id')]
+
+@st.cache_data(ttl=60, max_entries=128)
+def _cached_user_vector_stores(user_id):
+    """Return (id, name, vector_store_id) tuples for the user's vector stores, cached across reruns."""
+    vector_stores = get_user_vector_stores(user_id).scalar('id', 'name', 'vector_store_id')
+    return [(str(pk), name, vector_store_id) for pk, name, vector_store_id in vector_stores]
+
+@st.cache_data(ttl=60, max_entries=128)
+def _cached_user_assistants(user_id):
+    """Return (id, name, assistant_id, vector_store_id) tuples for the user's assistants, cached across reruns."""
+    return [
+        # Assistants created before vector_store_id was denormalized fall back to the reference
+        (str(a.id), a.name, a.assistant_id, a.vector_store_id or (a.vector_store.vector_store_id if a.vector_store else None))
+        for a in get_user_assistants(user_id).only('name', 'assistant_id', 'vector_store_id', 'vector_store')
+    ]
+
 def create_new_chat(current_user):
     """Create a new chat session."""
     st.title("Start a New Chat")
 
-    # Step 1: Select or Upload Files
+    # Each step is a fragment so interacting with one step doesn't rerun the others
+    display_file_step(current_user)
+    display_vector_store_step(current_user)
+    display_assistant_step(current_user)
+    display_session_step(current_user)
+
+@st.fragment
+def display_file_step(current_user):
+    """Step 1: select previously uploaded files or upload new ones."""
     st.header("Step 1: Select or Upload Files")
 
     # Display user's uploaded files
-    user_files = get_user_files(current_user)
-    file_options = [f.name for f in user_files]
+    user_files = _cached_user_files(str(current_user.id))
+    file_names = {file_id: name for _, name, file_id in user_files}
 
-    selected_files = st.multiselect(
+    # Options are OpenAI file IDs, so files that share a name stay distinct;
+    # keyed so Step 2 can read the selection from session state
+    st.multiselect(
         "Select from your uploaded files:",
-        options=file_options
+        options=list(file_names),
+        format_func=lambda file_id: file_names[file_id],
+        key='selected_files'
     )
 
     # Allow user to upload new files
     st.write("Or upload new files:")
     
-    # Initialize session state for tracking uploaded files if not exists
-    if 'uploaded_file_names' not in st.session_state:
-        st.session_state.uploaded_file_names = set()
-    
     uploaded_files = st.file_uploader(
         'Upload your study materials (.pdf, .txt, etc.)',
         type=['pdf', 'txt'],
@@ -63,45 +106,93 @@ def create_new_chat(current_user):
         accept_multiple_files=True
     )
 
+    # Report the outcome of the last finished upload batch once
+    upload_summary = st.session_state.pop('upload_summary', None)
+    if upload_summary:
+        st.success(upload_summary)
+
+    if 'pending_uploads' not in st.session_state:
+        st.session_state.pending_uploads = {}
+    pending_uploads = st.session_state.pending_uploads
+
     if st.button('Upload File(s)'):
         if uploaded_files:
-            progress_bar = st.progress(0)
-            status_text = st.empty()
+            # Filter out files that are still uploading; stored duplicates are caught by content hash
+            new_files = [f for f in uploaded_files if f.file_id not in pending_uploads]
             
-            try:
-                # Filter out already uploaded files
-                new_files = [f for f in uploaded_files if f.name not in st.session_state.uploaded_file_names]
-                
-                if not new_files:
-                    st.info('All selected files have already been uploaded.')
+            # Skip files whose content was already uploaded, even under another name
+            # Hashes sit next to their files, so two uploads sharing a name can't collide
+            hashed_files = [(f, compute_content_hash(f)) for f in new_files]
+            seen_hashes = get_existing_content_hashes(current_user, [content_hash for _, content_hash in hashed_files])
+            unique_files = []
+            for file, content_hash in hashed_files:
+                if content_hash in seen_hashes:
+                    st.info(f'"{file.name}" has already been uploaded.')
                 else:
-                    total_files = len(new_files)
-                    for idx, file in enumerate(new_files, 1):
-                        status_text.text(f'Processing file {idx}/{total_files}: {file.name}')
-                        progress_bar.progress(idx/total_files)
-                        handle_file_upload([file], current_user)
-                        st.session_state.uploaded_file_names.add(file.name)
-                    
-                    progress_bar.progress(1.0)
-                    status_text.text('All files processed successfully!')
-                    st.success(f'{total_files} new file(s) uploaded successfully!')
-                    # Refresh file options after upload
-                    st.rerun()
-            except Exception as e:
-                st.error(f'Error uploading files: {str(e)}')
-            finally:
-                progress_bar.empty()
-                status_text.empty()
+                    seen_hashes.add(content_hash)
+                    unique_files.append((file, content_hash))
+            
+            if not unique_files:
+                st.info('All selected files have already been uploaded.')
+            else:
+                # Upload in the background so the script thread isn't blocked
+                executor = get_upload_executor()
+                for file, content_hash in unique_files:
+                    pending_uploads[file.file_id] = (file.name, executor.submit(
+                        save_uploaded_file, file, current_user, content_hash
+                    ))
         else:
             st.warning('Please select at least one file to upload.')
 
-    # Step 2: Select or Create Vector Store
+    if pending_uploads:
+        display_upload_status()
+
+@st.cache_resource
+def get_upload_executor():
+    """Return the process-wide pool that runs file uploads off the script thread."""
+    return ThreadPoolExecutor(max_workers=MAX_CONCURRENT_UPLOADS)
+
+@st.fragment(run_every=1)
+def display_upload_status():
+    """Poll the background uploads and report their progress until they all finish."""
+    pending_uploads = st.session_state.pending_uploads
+    finished = [name for name, future in pending_uploads.values() if future.done()]
+
+    with st.status(f'Uploading files ({len(finished)}/{len(pending_uploads)})...', expanded=True) as status:
+        for name, future in pending_uploads.values():
+            if not future.done():
+                st.write(f'⏳ {name}')
+            elif future.exception():
+                st.write(f'❌ {name}: {str(future.exception())}')
+            else:
+                st.write(f'✅ {name}')
+
+        if len(finished) < len(pending_uploads):
+            return
+        status.update(label='All files processed!', state='complete')
+
+    uploaded_count = 0
+    for name, future in pending_uploads.values():
+        if future.exception():
+            logging.error(f'Error uploading file "{name}": {str(future.exception())}')
+        else:
+            uploaded_count += 1
+
+    st.session_state.upload_summary = f'{uploaded_count}/{len(pending_uploads)} new file(s) uploaded successfully!'
+    st.session_state.pending_uploads = {}
+    _cached_user_files.clear()
+    # Rerun the page so Step 1 lists the new files
+    st.rerun()
+
+@st.fragment
+def display_vector_store_step(current_user):
+    """Step 2: select existing study materials or create a new vector store."""
     st.header("Step 2: Organize Your Study Materials")
 
-    vector_stores = get_user_vector_stores(current_user)
-    vector_store_options = [vs.name for vs in vector_stores]
+    vector_stores = _cached_user_vector_stores(str(current_user.id))
+    vector_store_names = {vs_id: name for _, name, vs_id in vector_stores}
 
-    if vector_store_options:
+    if vector_store_names:
         vector_store_selection = st.radio(
             "Would you like to use existing study materials or create new ones?",
             options=["Use Existing", "Create New"]
@@ -111,48 +202,58 @@ def create_new_chat(current_user):
         vector_store_selection = "Create New"
 
     if vector_store_selection == "Use Existing":
-        selected_vector_store_name = st.selectbox(
+        # The selectbox returns the ID directly, so no lookup is needed for the selection
+        vector_store_id = st.selectbox(
             "Select your study materials:",
-            options=vector_store_options
+            options=list(vector_store_names),
+            format_func=lambda vs_id: vector_store_names[vs_id]
         )
-        if selected_vector_store_name:
-            selected_vector_store = VectorStore.objects(name=selected_vector_store_name, user=current_user).first()
-            if selected_vector_store:
-                st.session_state.vector_store_id = selected_vector_store.vector_store_id
-                st.success(f'Selected materials: {selected_vector_store.name}')
-            else:
-                st.error('Selected study materials not found.')
+        if vector_store_id:
+            vector_store_name = vector_store_names[vector_store_id]
+            if st.session_state.get('vector_store_id') != vector_store_id:
+                st.session_state.vector_store_id = vector_store_id
+                st.session_state.vector_store_name = vector_store_name
+                # Rerun the whole page so Step 4 reflects the new selection
+                st.rerun()
+            st.success(f'Selected materials: {vector_store_name}')
     else:  # Create New
         vector_store_name = st.text_input(
             'Name for your study materials:',
             placeholder='e.g., Physics Chapter 1, Math Notes, etc.'
         )
         if st.button('Create Collection', help='Create a new collection of study materials'):
+            selected_files = st.session_state.get('selected_files', [])
             if not vector_store_name.strip():
                 st.warning('Please enter a name for your study materials.')
             elif selected_files:
-                # Get File IDs of selected files
-                selected_file_objs = File.objects(name__in=selected_files, user=current_user)
-                selected_file_ids = [f.file_id for f in selected_file_objs]
+                # The selection already holds File IDs; keep only ones still in the cached file list
+                user_file_ids = {file_id for _, _, file_id in _cached_user_files(str(current_user.id))}
+                selected_file_ids = [file_id for file_id in selected_files if file_id in user_file_ids]
 
                 # Create vector store and associate files
                 vector_store_id = create_vector_store(vector_store_name, selected_file_ids, current_user)
                 if vector_store_id:
                     st.session_state.vector_store_id = vector_store_id
+                    st.session_state.vector_store_name = vector_store_name
                     st.success(f'Study materials "{vector_store_name}" created successfully.')
+                    # Reload only the vector store list; Step 4 needs the full rerun
+                    _cached_user_vector_stores.clear()
                     st.rerun()
                 else:
                     st.error('Failed to create study materials.')
             else:
                 st.warning('Please select at least one file above.')
 
-    # Step 3: Select or Create Assistant
+@st.fragment
+def display_assistant_step(current_user):
+    """Step 3: select an existing assistant or create a new one."""
     st.header("Step 3: Choose Your Study Assistant")
 
-    assistants = get_user_assistants(current_user)
-    assistant_options = [assistant.name for assistant in assistants]
+    assistants = _cached_user_assistants(str(current_user.id))
+    assistant_names = {asst_id: name for _, name, asst_id, _ in assistants}
+    assistant_vector_stores = {asst_id: vs_id for _, _, asst_id, vs_id in assistants}
 
-    if assistant_options:
+    if assistant_names:
         assistant_selection = st.radio(
             "Would you like to use an existing assistant or create a new one?",
             options=["Use Existing", "Create New"]
@@ -162,18 +263,22 @@ def create_new_chat(current_user):
         assistant_selection = "Create New"
 
     if assistant_selection == "Use Existing":
-        selected_assistant_name = st.selectbox(
+        # The selectbox returns the ID directly, so no lookup is needed for the selection
+        assistant_id = st.selectbox(
             "Select your study assistant:",
-            options=assistant_options
+            options=list(assistant_names),
+            format_func=lambda asst_id: assistant_names[asst_id]
         )
-        if selected_assistant_name:
-            selected_assistant = Assistant.objects(name=selected_assistant_name, user=current_user).first()
-            if selected_assistant:
-                st.session_state.assistant_id = selected_assistant.assistant_id
-                if selected_assistant.vector_store:
-                    st.info(f"This assistant was last used with: {selected_assistant.vector_store.name}")
-            else:
-                st.error('Selected assistant not found.')
+        if assistant_id:
+            if st.session_state.get('assistant_id') != assistant_id:
+                st.session_state.assistant_id = assistant_id
+                st.session_state.assistant_name = assistant_names[assistant_id]
+                # Rerun the whole page so Step 4 reflects the new selection
+                st.rerun()
+            vector_store_names = {vs_id: name for _, name, vs_id in _cached_user_vector_stores(str(current_user.id))}
+            vector_store_name = vector_store_names.get(assistant_vector_stores[assistant_id])
+            if vector_store_name:
+                st.info(f"This assistant was last used with: {vector_store_name}")
     else:  # Create New
         assistant_name = st.text_input(
             'Name for your study assistant:',
@@ -189,24 +294,25 @@ def create_new_chat(current_user):
                     assistant_id = create_assistant(assistant_name, st.session_state.vector_store_id, current_user)
                     if assistant_id:
                         st.session_state.assistant_id = assistant_id
+                        st.session_state.assistant_name = assistant_name
                         st.success('Assistant created successfully!')
+                        # Reload only the assistant list; Step 4 needs the full rerun
+                        _cached_user_assistants.clear()
                         st.rerun()
                 except Exception as e:
                     st.error(f'Error creating assistant: {str(e)}')
 
-    # Step 4: Start Your Study Session
+@st.fragment
+def display_session_step(current_user):
+    """Step 4: name and start the study session."""
     st.header("Step 4: Start Your Study Session")
     
-    # Show helpful context about what's selected
-    if st.session_state.get('vector_store_id'):
-        vs = VectorStore.objects(vector_store_id=st.session_state.vector_store_id).first()
-        if vs:
-            st.info(f"📚 Study Materials: {vs.name}")
+    # Show helpful context about what's selected, using the names stored at selection time
+    if st.session_state.get('vector_store_id') and st.session_state.get('vector_store_name'):
+        st.info(f"📚 Study Materials: {st.session_state.vector_store_name}")
     
-    if st.session_state.get('assistant_id'):
-        asst = Assistant.objects(assistant_id=st.session_state.assistant_id).first()
-        if asst:
-            st.info(f"🤖 Study Assistant: {asst.name}")
+    if st.session_state.get('assistant_id') and st.session_state.get('assistant_name'):
+        st.info(f"🤖 Study Assistant: {st.session_state.assistant_name}")
     
     session_title = st.text_input('Title for this study session:', 'New study session')
     start_disabled = not (st.session_state.get('assistant_id') and st.session_state.get('vector_store_id'))
@@ -219,31 +325,50 @@ def create_new_chat(current_user):
                 vector_store_id=st.session_state.vector_store_id,
                 user=current_user
             )
+            _cached_threads.clear()
             st.success('Study session started successfully! You can now interact with your assistant from the Previous Sessions section.')
         except Exception as e:
             logging.error(f"Error creating study session: {str(e)}")
             st.error(f'Error creating study session: {str(e)}')
 
+# Cache entries are shared by every session in the process, so they are cleared
+# on create/delete and expire quickly to pick up changes made by other processes
+@st.cache_data(ttl=30, max_entries=128)
+def _cached_threads(user_id, limit):
+    """Return the user's latest threads, cached across reruns."""
+    return list(get_threads(user_id, limit=limit))
+
 def select_thread_sidebar(current_user):
     """Display study session selection in the sidebar."""
-    threads = get_threads(current_user)
+    # Only load the most recent sessions; older ones are paged in on request
+    thread_limit = st.session_state.setdefault('thread_limit', THREAD_PAGE_SIZE)
+    threads = _cached_threads(str(current_user.id), thread_limit)
     if threads:
         st.sidebar.header("Your Study Sessions")
+        threads_by_id = {thread.thread_id: thread for thread in threads}
         selected_thread_id = st.sidebar.selectbox(
             "Choose a session:",
-            options=[thread.thread_id for thread in threads],
-            format_func=lambda x: next((thread.title for thread in threads if thread.thread_id == x), "Untitled Session")
+            options=list(threads_by_id),
+            format_func=lambda tid: threads_by_id[tid].title or "Untitled Session"
         )
 
+        if len(threads) == thread_limit and st.sidebar.button("Show Older Sessions"):
+            st.session_state.thread_limit += THREAD_PAGE_SIZE
+            st.rerun()
+
         if st.sidebar.button("Delete Selected Session"):
             if delete_thread(selected_thread_id):
                 st.sidebar.success("Study session deleted successfully.")
                 st.session_state.thread_id = None
+                clear_chat_history(selected_thread_id)
+                _cached_threads.clear()
+                threads_by_id.pop(selected_thread_id, None)
             else:
                 st.sidebar.error("Failed to delete the study session.")
 
         st.session_state.thread_id = selected_thread_id
-        return Thread.objects(thread_id=selected_thread_id).first()
+        # Reuse the already loaded threads instead of querying for the selection
+        return threads_by_id.get(selected_thread_id)
     return None
 
 def display_thread(selected_thread):
@@ -251,21 +376,62 @@ def display_thread(selected_thread):
     st.title(f"Study Session: {selected_thread.title}")
     handle_chat_interface(selected_thread)
 
+def get_chat_history(thread_id):
+    """Return the thread's chat history from session state, loading its latest page from MongoDB on first use."""
+    history_key = f'messages::{thread_id}'
+    if history_key not in st.session_state:
+        # A reply still being saved in the background must be in the database before reloading
+        wait_for_pending_save()
+        messages = get_messages(thread_id, limit=MESSAGE_PAGE_SIZE)
+        st.session_state[history_key] = {
+            'messages': [(message.role, message.content) for message in messages],
+            'has_earlier': len(messages) == MESSAGE_PAGE_SIZE,
+            'oldest': (messages[0].created_at, messages[0].id) if messages else None
+        }
+    return st.session_state[history_key]
+
+def load_earlier_messages(thread_id, history):
+    """Prepend the page of messages older than the oldest one already in the history."""
+    messages = get_messages(thread_id, limit=MESSAGE_PAGE_SIZE, before=history['oldest'])
+    history['messages'][:0] = [(message.role, message.content) for message in messages]
+    history['has_earlier'] = len(messages) == MESSAGE_PAGE_SIZE
+    if messages:
+        history['oldest'] = (messages[0].created_at, messages[0].id)
+
+def wait_for_pending_save():
+    """Block until the last assistant reply queued for saving has been written."""
+    pending_save = st.session_state.pop('pending_save', None)
+    if pending_save:
+        try:
+            pending_save.result()
+        except Exception as e:
+            logging.error(f"Failed to save assistant message: {str(e)}")
+
+def clear_chat_history(thread_id):
+    """Drop a thread's chat history from session state so it is reloaded on next use."""
+    st.session_state.pop(f'messages::{thread_id}', None)
+
+@st.fragment
 def handle_chat_interface(selected_thread):
     """Handle the chat interface for the selected study session."""
     if not selected_thread:
         st.info('No study session selected. Start a new session from the New Study Session tab.')
         return
 
+    client = get_client()
     thread_id = selected_thread.thread_id
     st.session_state.thread_id = thread_id
     st.session_state.assistant_id = selected_thread.assistant_id
 
-    # Display saved messages
-    saved_messages = get_messages(st.session_state.thread_id)
-    for message in saved_messages:
-        with st.chat_message(message.role):
-            st.markdown(message.content, unsafe_allow_html=True)
+    # Display the latest saved messages; earlier ones are loaded on request
+    history = get_chat_history(thread_id)
+    if history['has_earlier'] and st.button("Load earlier messages"):
+        # The history is drawn below, so the prepended page shows without a rerun
+        load_earlier_messages(thread_id, history)
+
+    for role, content in history['messages']:
+        with st.chat_message(role):
+            st.markdown(content, unsafe_allow_html=True)
 
     # Get user input
     prompt = st.chat_input('Ask a question or send a message')
@@ -274,8 +440,11 @@ def handle_chat_interface(selected_thread):
         with st.chat_message('user'):
             st.markdown(prompt)
 
-        # Save and send user message
-        save_message(st.session_state.thread_id, 'user', prompt)
+        # Keep messages in order by letting the previous reply's save finish first
+        wait_for_pending_save()
+
+        # Save the user message in the background while it is sent to OpenAI
+        save_future = io_executor.submit(save_message, selected_thread, 'user', prompt)
         try:
             client.beta.threads.messages.create(
                 thread_id=st.session_state.thread_id,
@@ -286,6 +455,10 @@ def handle_chat_interface(selected_thread):
             st.error(f"Failed to send message to OpenAI: {str(e)}")
             logging.error(f"Failed to send message to OpenAI: {str(e)}")
             return
+        finally:
+            # Make sure the user message is persisted before the run starts
+            save_future.result()
+            history['messages'].append(('user', prompt))
 
         # Stream the assistant's response
         with st.chat_message('assistant'):
@@ -293,40 +466,41 @@ def handle_chat_interface(selected_thread):
             assistant_response = ""         # Accumulates the complete response
             
             try:
-                stream = client.beta.threads.runs.create(
+                with client.beta.threads.runs.stream(
                     thread_id=st.session_state.thread_id,
-                    assistant_id=st.session_state.assistant_id,
-                    stream=True
-                )
-                
-                for event in stream:
-                    if isinstance(event, ThreadMessageDelta):
-                        if isinstance(event.data.delta.content[0], TextDeltaBlock):
-                            streaming_display.empty()
-                            assistant_response += event.data.delta.content[0].text.value
+                    assistant_id=st.session_state.assistant_id
+                ) as stream:
+                    # Markdown replaces the placeholder's content, so only redraw
+                    # once enough new text has accumulated
+                    flushed_length = 0
+                    for text_delta in stream.text_deltas:
+                        assistant_response += text_delta
+                        if len(assistant_response) - flushed_length > STREAM_FLUSH_CHARS:
                             streaming_display.markdown(assistant_response)
-                
-                # After streaming completes, handle annotations
-                messages = client.beta.threads.messages.list(
-                    thread_id=st.session_state.thread_id
-                )
-                
-                # Extract the message content
-                message_content = messages.data[0].content[0].text
-                annotations = message_content.annotations
-
-                # Iterate over the annotations and add footnotes
-                for index, annotation in enumerate(annotations, start=1):
-                    # Replace the text with a footnote
-                    assistant_response = assistant_response.replace(
-                        annotation.text, f' <sup>[{index}]</sup>'
-                    )
+                            flushed_length = len(assistant_response)
+
+                    # The stream already holds the completed messages, so no extra list call is needed
+                    final_messages = stream.get_final_messages()
+
+                # Collect the annotations of the generated text
+                annotations = [
+                    annotation
+                    for message in final_messages
+                    for block in message.content if block.type == 'text'
+                    for annotation in block.text.annotations
+                ]
+
+                # Replace the annotation markers with footnotes
+                assistant_response = add_footnotes(assistant_response, annotations)
                 
                 # Update the display with annotations
                 streaming_display.markdown(assistant_response, unsafe_allow_html=True)
 
-                # Save the final message with annotations
-                save_message(st.session_state.thread_id, 'assistant', assistant_response)
+                # Save the final message with annotations off the script thread
+                st.session_state.pending_save = io_executor.submit(
+                    save_message, selected_thread, 'assistant', assistant_response
+                )
+                history['messages'].append(('assistant', assistant_response))
                 
             except Exception as e:
                 st.error(f"Error during streaming: {str(e)}")
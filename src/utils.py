@@ -1,72 +1,110 @@
+import hashlib
 import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from io import BytesIO
-from typing import Optional
+from functools import lru_cache
 
 import streamlit as st
+from mongoengine import Q
 
-from config import MODEL, client
+from config import MODEL, get_client
 from models import Message, Thread, User, File, VectorStore, Assistant
 
-# ----------------------------
-# Custom BytesIO Subclass
-# ----------------------------
+# Shared worker pool used to overlap MongoDB writes with OpenAI round-trips
+io_executor = ThreadPoolExecutor(max_workers=4)
+
+# Files larger than this go through the multipart Uploads API instead of a single request
+LARGE_FILE_THRESHOLD = 100 * 1024 * 1024
+
+# Size of each part sent to the Uploads API (the API caps parts at 64 MB)
+UPLOAD_PART_SIZE = 64 * 1024 * 1024
+
+# Instructions given to every study assistant
+ASSISTANT_INSTRUCTIONS = (
+    "You are an AI study assistant called 'Study Buddy'. Your role is to help students learn and understand various concepts in their field of study.\n\n"
+    "When a student asks a question, provide clear and concise explanations of the relevant topics. Break down complex concepts into easily understandable parts. Share helpful resources, such as academic papers, tutorials, or online courses, that can further enhance their understanding.\n\n"
+    "Engage in meaningful discussions with the student to deepen their understanding of the subject matter. Encourage them to think critically and ask questions. Help them develop problem-solving skills and provide guidance on practical applications of the concepts they are learning.\n\n"
+    "Be friendly, supportive, and patient in your interactions. Motivate the student to stay curious and persistent in their learning journey. Foster a positive and encouraging learning environment.\n\n"
+    "Tailor your responses to the student's level of understanding and learning style. Adapt your explanations and examples to make the content more relatable and accessible.\n\n"
+    "Remember, your goal is to empower the student to grasp the material effectively and develop a strong foundation in their chosen field of study."
+)
 
-class NamedBytesIO(BytesIO):
-    """
-    A subclass of BytesIO that includes a 'name' attribute.
-    """
-    def __init__(self, initial_bytes: Optional[bytes] = None, name: Optional[str] = None) -> None:
-        super().__init__(initial_bytes)
-        self.name = name
+# Tools enabled on every study assistant
+ASSISTANT_TOOLS = ({'type': 'code_interpreter'}, {'type': 'file_search'})
 
 # ----------------------------
 # Helper Functions
 # ----------------------------
 
-def handle_file_upload(uploaded_files, current_user):
-    """Handle the file upload process for the current user."""
-    if not uploaded_files:
-        st.warning('Please select a file to upload.')
-        return
+def compute_content_hash(file):
+    """Return a short BLAKE2b digest of an uploaded file's bytes."""
+    return hashlib.blake2b(file.getbuffer(), digest_size=16).hexdigest()
+
+def get_existing_content_hashes(user, content_hashes):
+    """Return the subset of content hashes the user has already uploaded."""
+    return set(File.objects(user=user, content_hash__in=list(content_hashes)).scalar('content_hash'))
+
+def save_uploaded_file(file, current_user, content_hash=None):
+    """Upload a single file to OpenAI and save it in the File model, without touching the UI."""
+    # UploadedFile is already a named file-like object, so hand it over as-is
+    # instead of copying its bytes into a second buffer
+    file.seek(0)
+
+    # Upload the file to OpenAI
+    file_id = upload_to_openai(file, file.name)
+
+    # Save the file in the File model
+    new_file = File(
+        file_id=file_id,
+        name=file.name,
+        content_hash=content_hash or compute_content_hash(file),
+        user=current_user,
+        created_at=datetime.now(timezone.utc)
+    )
+    new_file.save()
+    logging.debug('File "%s" saved to database with ID: %s', file.name, file_id)
+    return new_file
 
-    for file in uploaded_files:
-        try:
-            # Use the NamedBytesIO subclass
-            named_upload_buffer = NamedBytesIO(file.getbuffer(), name=file.name)
-            
-            # Upload the file to OpenAI
-            file_id = upload_to_openai(named_upload_buffer, named_upload_buffer.name)
-            logging.debug(f'File "{named_upload_buffer.name}" uploaded to OpenAI with ID: {file_id}')
-            st.success(f'File "{named_upload_buffer.name}" uploaded successfully.')
-
-            # Save the file in the File model
-            new_file = File(
-                file_id=file_id,
-                name=file.name,
-                user=current_user,
-                created_at=datetime.now(timezone.utc)
-            )
-            new_file.save()
-            logging.debug(f'File "{file.name}" saved to database with ID: {file_id}')
-
-        except Exception as e:
-            st.error(f'Error uploading file "{file.name}": {str(e)}')
-            logging.error(f'Error uploading file "{file.name}": {str(e)}')
-
-    st.info("Files are being processed and will be available shortly.")
-
-def upload_to_openai(named_upload_buffer: NamedBytesIO, filename: str) -> str:
+def upload_to_openai(upload_file, filename: str) -> str:
     """Upload a file to OpenAI and return the file ID."""
     try:
-        response = client.files.create(file=named_upload_buffer, purpose='assistants')
-        logging.debug(f"File '{filename}' uploaded to OpenAI with ID: {response.id}")
-        return response.id
+        if getattr(upload_file, 'size', 0) > LARGE_FILE_THRESHOLD:
+            file_id = upload_large_file_to_openai(upload_file, filename)
+        else:
+            file_id = get_client().files.create(file=upload_file, purpose='assistants').id
+        logging.debug("File '%s' uploaded to OpenAI with ID: %s", filename, file_id)
+        return file_id
     except Exception as e:
+        # Callers report the error; this may run outside the Streamlit script thread
         logging.error(f"Failed to upload file {filename}: {str(e)}")
-        st.sidebar.error(f"Failed to upload file {filename}: {str(e)}")
         raise e
 
+def upload_large_file_to_openai(upload_file, filename: str) -> str:
+    """Upload a large file to OpenAI in parts through the Uploads API and return the file ID."""
+    client = get_client()
+    upload = client.uploads.create(
+        purpose='assistants',
+        filename=filename,
+        bytes=upload_file.size,
+        mime_type=upload_file.type or 'application/octet-stream'
+    )
+
+    try:
+        # Send one bounded chunk at a time rather than the whole file in one body
+        part_ids = []
+        upload_file.seek(0)
+        while chunk := upload_file.read(UPLOAD_PART_SIZE):
+            part_ids.append(client.uploads.parts.create(upload_id=upload.id, data=chunk).id)
+
+        completed = client.uploads.complete(upload_id=upload.id, part_ids=part_ids)
+    except Exception as e:
+        # Don't leave the Upload open on OpenAI's side until it expires
+        logging.error(f"Cancelling upload {upload.id} for file {filename}: {str(e)}")
+        client.uploads.cancel(upload.id)
+        raise e
+    return completed.file.id
+
 def get_user_files(user):
     """Retrieve all files uploaded by the user."""
     return File.objects(user=user)
@@ -75,7 +113,7 @@ def create_vector_store(name, selected_file_ids, current_user):
     """Create a new vector store and associate selected files."""
     try:
         # Create vector store via OpenAI API
-        vector_store = client.beta.vector_stores.create(name=name)
+        vector_store = get_client().beta.vector_stores.create(name=name)
         vector_store_id = vector_store.id
 
         # Save the vector store in the database
@@ -86,7 +124,7 @@ def create_vector_store(name, selected_file_ids, current_user):
             created_at=datetime.now(timezone.utc)
         )
         new_vector_store.save()
-        logging.debug(f'Vector store "{name}" saved to database with ID: {vector_store_id}')
+        logging.debug('Vector store "%s" saved to database with ID: %s', name, vector_store_id)
 
         # Attach selected files to the vector store
         create_vector_store_files(vector_store_id, selected_file_ids)
@@ -99,28 +137,42 @@ def create_vector_store(name, selected_file_ids, current_user):
 
 def create_vector_store_files(vector_store_id, file_ids):
     """Attach files to a vector store."""
-    for file_id in file_ids:
-        try:
-            client.beta.vector_stores.files.create(
-                vector_store_id=vector_store_id,
-                file_id=file_id
-            )
-            logging.debug(f'File ID "{file_id}" attached to vector store ID: {vector_store_id}')
-        except Exception as e:
-            logging.error(f'Error attaching file ID "{file_id}" to vector store "{vector_store_id}": {str(e)}')
-            st.error(f'Error attaching file to vector store: {str(e)}')
+    if not file_ids:
+        return
+
+    try:
+        # Attach all files in a single batch request instead of one request per file
+        get_client().beta.vector_stores.file_batches.create(
+            vector_store_id=vector_store_id,
+            file_ids=list(file_ids)
+        )
+        logging.debug('File IDs %s attached to vector store ID: %s', file_ids, vector_store_id)
+    except Exception as e:
+        logging.error(f'Error attaching files to vector store "{vector_store_id}": {str(e)}')
+        st.error(f'Error attaching files to vector store: {str(e)}')
+
+@st.cache_data(ttl=300, show_spinner=False)
+def list_vector_store_files(vector_store_id):
+    """Fetch the files of a vector store from OpenAI, cached per vector store ID."""
+    client = get_client()
+    # Iterating the page follows the cursor, so stores with more than one page are listed in full
+    file_ids = [file.id for file in client.beta.vector_stores.files.list(vector_store_id=vector_store_id, limit=100)]
+
+    # Names come from our own File records in one query; only unknown files are retrieved from OpenAI
+    names = dict(File.objects(file_id__in=file_ids).scalar('file_id', 'name'))
+    file_details = [
+        {'name': names.get(file_id) or client.files.retrieve(file_id).filename, 'id': file_id}
+        for file_id in file_ids
+    ]
+    logging.debug("Retrieved files from vector store %s: %s", vector_store_id, file_details)
+    return file_details
 
 def get_vector_store_files(vector_store_id):
     """Retrieve the list of uploaded files for a vector store."""
     try:
-        files_list = client.beta.vector_stores.files.list(vector_store_id=vector_store_id)
-        file_details = [
-            {'name': client.files.retrieve(file.id).filename, 'id': file.id}
-            for file in files_list.data
-        ]
-        logging.debug(f"Retrieved files from vector store {vector_store_id}: {file_details}")
-        return file_details
+        return list_vector_store_files(vector_store_id)
     except Exception as e:
+        # Failures raise out of the cached call, so they are never cached
         logging.error(f"Failed to retrieve files for vector store {vector_store_id}: {str(e)}")
         return []
 
@@ -131,27 +183,18 @@ def get_user_vector_stores(user):
 def create_assistant(name, vector_store_id, user):
     """Create an assistant using the provided vector_store_id and save it to the database."""
     try:
-        # Define the assistant's instructions and tools
-        assistant_instructions = (
-            "You are an AI study assistant called 'Study Buddy'. Your role is to help students learn and understand various concepts in their field of study.\n\n"
-            "When a student asks a question, provide clear and concise explanations of the relevant topics. Break down complex concepts into easily understandable parts. Share helpful resources, such as academic papers, tutorials, or online courses, that can further enhance their understanding.\n\n"
-            "Engage in meaningful discussions with the student to deepen their understanding of the subject matter. Encourage them to think critically and ask questions. Help them develop problem-solving skills and provide guidance on practical applications of the concepts they are learning.\n\n"
-            "Be friendly, supportive, and patient in your interactions. Motivate the student to stay curious and persistent in their learning journey. Foster a positive and encouraging learning environment.\n\n"
-            "Tailor your responses to the student's level of understanding and learning style. Adapt your explanations and examples to make the content more relatable and accessible.\n\n"
-            "Remember, your goal is to empower the student to grasp the material effectively and develop a strong foundation in their chosen field of study."
-        )
         # Create the assistant via OpenAI API
-        assistant = client.beta.assistants.create(
-            instructions=assistant_instructions,
+        assistant = get_client().beta.assistants.create(
+            instructions=ASSISTANT_INSTRUCTIONS,
             name=name,
-            tools=[{'type': 'code_interpreter'}, {'type': 'file_search'}],
+            tools=list(ASSISTANT_TOOLS),
             tool_resources={'file_search': {'vector_store_ids': [vector_store_id]}},
             model=MODEL,
         )
         if not assistant.id:
             logging.error("Assistant creation returned without an ID.")
             raise ValueError("Assistant creation returned without an ID.")
-        logging.debug(f"Assistant created with ID: {assistant.id}")
+        logging.debug("Assistant created with ID: %s", assistant.id)
 
         # Save the assistant to the database
         vector_store = VectorStore.objects(vector_store_id=vector_store_id).first()
@@ -159,11 +202,12 @@ def create_assistant(name, vector_store_id, user):
             assistant_id=assistant.id,
             name=name,
             vector_store=vector_store,
+            vector_store_id=vector_store_id,
             user=user,
             created_at=datetime.now(timezone.utc)
         )
         new_assistant.save()
-        logging.debug(f"Assistant '{name}' saved to database with ID: {assistant.id}")
+        logging.debug("Assistant '%s' saved to database with ID: %s", name, assistant.id)
 
         # Set success message in session state
         st.session_state.assistant_created = True
@@ -185,28 +229,30 @@ def create_thread(title='New thread', assistant_id=None, vector_store_id=None, u
     vector_store = VectorStore.objects(vector_store_id=vector_store_id).first()
 
     # Create a new thread via OpenAI API
-    new_thread_id = client.beta.threads.create().id
+    new_thread_id = get_client().beta.threads.create().id
+    # A new thread's creation and last-update times are the same instant
+    now = datetime.now(timezone.utc)
     new_thread = Thread(
         thread_id=new_thread_id,
         vector_store=vector_store,
         assistant_id=assistant_id,
         title=title,
-        created_at=datetime.now(timezone.utc),
-        updated_at=datetime.now(timezone.utc),
+        created_at=now,
+        updated_at=now,
         user=user
     )
     new_thread.save()
-    logging.debug(f"Thread '{title}' created with ID: {new_thread.thread_id} for user: {user.username}")
+    logging.debug("Thread '%s' created with ID: %s for user: %s", title, new_thread.thread_id, user.username)
     return new_thread
 
 def delete_thread(thread_id):
     """Delete a thread and its associated messages from the database and OpenAI."""
     try:
-        thread = Thread.objects(thread_id=thread_id).first()
+        thread = Thread.objects(thread_id=thread_id).only('id').first()
         if thread:
             # Delete the thread from OpenAI
             try:
-                response = client.beta.threads.delete(thread_id)
+                response = get_client().beta.threads.delete(thread_id)
                 if not response.deleted:
                     logging.error(f"Failed to delete thread {thread_id} from OpenAI.")
                     return False
@@ -216,11 +262,12 @@ def delete_thread(thread_id):
 
             # Delete associated messages from local database
             Message.objects(thread=thread).delete()
+
+            # Delete the thread from local database directly; Document.delete() would
+            # re-run Message.thread's CASCADE rule and query the messages again
+            Thread._get_collection().delete_one({'_id': thread.pk})
             
-            # Delete the thread from local database
-            thread.delete()
-            
-            logging.debug(f"Thread {thread_id} and its messages deleted successfully from both OpenAI and local database.")
+            logging.debug("Thread %s and its messages deleted successfully from both OpenAI and local database.", thread_id)
             return True
         else:
             logging.warning(f"Thread {thread_id} not found for deletion.")
@@ -229,40 +276,85 @@ def delete_thread(thread_id):
         logging.error(f"Error deleting thread {thread_id}: {str(e)}")
         return False
 
-def get_threads(user):
-    """Retrieve all threads for a specific user."""
-    return Thread.objects(user=user).order_by('-updated_at')
+def get_threads(user, limit=50):
+    """Retrieve the most recently updated threads for a specific user."""
+    return (
+        Thread.objects(user=user)
+        .only('thread_id', 'title', 'assistant_id', 'updated_at')
+        .order_by('-updated_at')
+        .limit(limit)
+    )
 
-def save_message(thread_id, role, content):
-    """Save a message to the database."""
-    current_thread = Thread.objects(thread_id=thread_id).first()
+def save_message(thread, role, content):
+    """Save a message to the database; thread is a Thread document or its thread_id."""
+    # Callers that already hold the Thread skip the lookup entirely
+    current_thread = thread if isinstance(thread, Thread) else Thread.objects(thread_id=thread).only('id').first()
     if not current_thread:
-        raise ValueError(f'No thread found for thread_id: {thread_id}')
+        raise ValueError(f'No thread found for thread_id: {thread}')
     Message(
         thread=current_thread,
         role=role,
         content=content,
         created_at=datetime.now(timezone.utc)
     ).save()
-    current_thread.update(updated_at=datetime.now(timezone.utc))  # Use update for efficiency
+    # Let MongoDB stamp updated_at server-side, without a read-modify-write
+    current_thread.update(__raw__={'$currentDate': {'updated_at': True}})
 
-def get_messages(thread_id):
-    """Retrieve messages for a thread."""
-    current_thread = Thread.objects(thread_id=thread_id).first()
-    if current_thread:
-        return Message.objects(thread=current_thread).order_by('created_at')
-    return []
+def get_messages(thread_id, limit=None, before=None):
+    """Retrieve messages for a thread in chronological order, optionally only the latest `limit` before the `(created_at, id)` key `before`."""
+    current_thread = Thread.objects(thread_id=thread_id).only('id').first()
+    if not current_thread:
+        return []
+    # Only project the fields needed to render the chat history
+    messages = Message.objects(thread=current_thread).only('role', 'content', 'created_at')
+    if before is not None:
+        # Keyset pagination on (created_at, id), so messages sharing a timestamp aren't skipped
+        created_at, message_id = before
+        messages = messages.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=message_id))
+    if limit is None:
+        return list(messages.order_by('created_at', 'id'))
+    # Fetch the newest messages first so the limit keeps the latest ones
+    latest = messages.order_by('-created_at', '-id').limit(limit)
+    return list(reversed(list(latest)))
+
+@lru_cache(maxsize=128)
+def compile_annotation_pattern(texts):
+    """Compile (and cache) a single regex matching any of the given annotation texts."""
+    # Longest first so an annotation that is a prefix of another cannot shadow it
+    ordered = sorted(texts, key=len, reverse=True)
+    return re.compile('|'.join(re.escape(text) for text in ordered))
+
+def add_footnotes(text, annotations):
+    """Replace annotation markers in the text with numbered footnotes in a single pass."""
+    footnotes = {}
+    for index, annotation in enumerate(annotations, start=1):
+        if annotation.text:
+            footnotes.setdefault(annotation.text, f' <sup>[{index}]</sup>')
+    if not footnotes:
+        return text
+
+    pattern = compile_annotation_pattern(tuple(footnotes))
+    return pattern.sub(lambda match: footnotes[match.group(0)], text)
 
 def save_user(username, name, email):
     """Save the newly registered user to MongoDB."""
-    if not User.objects(username=username).first():
-        new_user = User(
-            username=username,
-            name=name,
-            email=email
-        )
-        new_user.save()
-        logging.debug(f"User {username} successfully saved to MongoDB.")
+    # Upserts bypass document validation, so validate the new user like save() would
+    new_user = User(
+        username=username,
+        name=name,
+        email=email,
+        created_at=datetime.now(timezone.utc)
+    )
+    new_user.validate()
+
+    # Insert only if the username is new, in a single round-trip that can't race another registration
+    result = User._get_collection().update_one(
+        {'username': username},
+        {'$setOnInsert': new_user.to_mongo()},
+        upsert=True
+    )
+    if result.upserted_id is not None:
+        logging.debug("User %s successfully saved to MongoDB.", username)
     else:
         logging.warning(f"User {username} already exists in the database.")
 
@@ -276,7 +368,9 @@ def initialize_session_state():
         'file_id_list': [],
         'thread_id': None,
         'assistant_id': None,
-        'vector_store_id': None
+        'assistant_name': None,
+        'vector_store_id': None,
+        'vector_store_name': None
     }
     for key, value in defaults.items():
         st.session_state.setdefault(key, value)